@@ -1,14 +1,23 @@
+import argparse
+import functools
+import html
 import json
 import os
 import sys
+import time
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta, timezone
-from dateutil import tz
+from zoneinfo import ZoneInfo
 import requests
-import yfinance as yf
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 STATE_PATH = "state.json"
 HOLDINGS_PATH = "holdings.json"
 CONFIG_PATH = "config.json"
+# Webhook-modus: een externe webhook schrijft Telegram-updates in dit bestand (zie README)
+PENDING_PATH = "pending_commands.json"
 
 TELEGRAM_TOKEN = os.getenv("TELEGRAM_TOKEN")
 TELEGRAM_CHAT_ID = os.getenv("TELEGRAM_CHAT_ID")
@@ -19,9 +28,47 @@ DEFAULT_RISE_PCT = float(os.getenv("DEFAULT_RISE_PCT", "5"))    # owned: +5%
 COOLDOWN_MINUTES_WATCH = int(os.getenv("COOLDOWN_MINUTES_WATCH", "720"))
 COOLDOWN_MINUTES_OWNED = int(os.getenv("COOLDOWN_MINUTES_OWNED", "1440"))
 
-if not TELEGRAM_TOKEN or not TELEGRAM_CHAT_ID:
-    print("ERROR: TELEGRAM_TOKEN en/of TELEGRAM_CHAT_ID ontbreken als secrets.", file=sys.stderr)
-    sys.exit(1)
+AMS_TZ = ZoneInfo("Europe/Amsterdam")
+
+# Handelstijden Euronext Amsterdam (ma-vr); daarbuiten alleen commando's verwerken
+MARKET_OPEN = (9, 0)
+MARKET_CLOSE = (17, 40)
+
+PRICE_FETCH_WORKERS = 16
+
+# Maximale lengte van één Telegram-bericht
+TELEGRAM_MAX_LEN = 4096
+
+# Server-side timeout voor getUpdates in --poll modus (long polling)
+TELEGRAM_LONG_POLL_SECONDS = 25
+# Wachttijd (verdubbelend) in --poll modus nadat Telegram tijdelijk niet bereikbaar was
+POLL_BACKOFF_SECONDS = 5
+POLL_BACKOFF_MAX_SECONDS = 300
+
+class _TelegramRetry(Retry):
+    """POST (sendMessage) alleen opnieuw bij 429: na een 5xx of read-timeout kan het bericht al afgeleverd zijn."""
+    def is_retry(self, method, status_code, has_retry_after=False):
+        if method and method.upper() == "POST":
+            return status_code == 429 and bool(self.total)
+        return super().is_retry(method, status_code, has_retry_after)
+
+# Eén sessie voor alle Telegram-calls: keep-alive i.p.v. een nieuwe TLS-handshake per call.
+# Retry vangt ook 429 (rate limit) af en respecteert Retry-After.
+_tg = requests.Session()
+_tg.mount("https://", HTTPAdapter(
+    pool_connections=4,
+    pool_maxsize=8,
+    max_retries=_TelegramRetry(
+        total=3,
+        backoff_factor=0.3,
+        status_forcelist=[429, 500, 502, 503, 504],
+    ),
+))
+
+# Chart-endpoint van Yahoo voor losse slotkoersen, zonder yfinance/pandas-omweg
+YAHOO_CHART_URL = "https://query2.finance.yahoo.com/v8/finance/chart/{symbol}"
+_yahoo = requests.Session()
+_yahoo.headers["User-Agent"] = "Mozilla/5.0"
 
 # ---------- Helpers ----------
 def load_json(path, default):
@@ -34,18 +81,43 @@ def load_json(path, default):
             return default
 
 def save_json(path, data):
-    with open(path, "w", encoding="utf-8") as f:
+    # Eerst naar een tijdelijk bestand, dan atomisch vervangen: nooit een half geschreven state
+    tmp = f"{path}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
         json.dump(data, f, indent=2, ensure_ascii=False)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+def pack_messages(blocks: list, sep: str = "\n\n", limit: int = TELEGRAM_MAX_LEN) -> list:
+    """Bundelt tekstblokken in zo weinig mogelijk berichten van hoogstens `limit` tekens."""
+    messages, current = [], ""
+    for block in blocks:
+        block = block[:limit]
+        if current and len(current) + len(sep) + len(block) > limit:
+            messages.append(current)
+            current = ""
+        current = f"{current}{sep}{block}" if current else block
+    if current:
+        messages.append(current)
+    return messages
 
 def send_telegram(msg: str):
     url = f"https://api.telegram.org/bot{TELEGRAM_TOKEN}/sendMessage"
     payload = {"chat_id": TELEGRAM_CHAT_ID, "text": msg, "parse_mode": "HTML", "disable_web_page_preview": True}
-    r = requests.post(url, json=payload, timeout=20)
+    r = _tg.post(url, json=payload, timeout=20)
     r.raise_for_status()
 
+@functools.lru_cache(maxsize=128)
+def _ticker(symbol: str):
+    # Hergebruik Ticker-objecten (en hun sessie/fast_info) binnen één run.
+    # yfinance (met pandas/numpy) pas importeren als er echt koersen nodig zijn.
+    import yfinance as yf
+    return yf.Ticker(symbol)
+
 def get_last_price(ticker: str) -> float | None:
     try:
-        t = yf.Ticker(ticker)
+        t = _ticker(ticker)
         p = None
         try:
             p = float(t.fast_info["last_price"])
@@ -60,21 +132,69 @@ def get_last_price(ticker: str) -> float | None:
         print(f"Waarschuwing: prijs ophalen mislukt voor {ticker}: {e}", file=sys.stderr)
         return None
 
+def get_last_prices(tickers: list) -> dict:
+    """Haalt prijzen parallel op (I/O-bound): {symbol: prijs of None}."""
+    tickers = list(dict.fromkeys(tickers))
+    if not tickers:
+        return {}
+    with ThreadPoolExecutor(max_workers=min(PRICE_FETCH_WORKERS, len(tickers))) as ex:
+        return dict(zip(tickers, ex.map(get_last_price, tickers)))
+
 def get_prev_close(ticker: str) -> float | None:
+    now = ams_now()
     try:
-        t = yf.Ticker(ticker)
-        hist = t.history(period="5d", interval="1d")
-        if hist.shape[0] >= 2:
-            return float(hist["Close"].iloc[-2])
-        elif hist.shape[0] == 1:
-            return float(hist["Close"].iloc[-1])
-        return None
+        url = YAHOO_CHART_URL.format(symbol=urllib.parse.quote(ticker, safe=""))
+        r = _yahoo.get(url, params={"range": "5d", "interval": "1d"}, timeout=10)
+        r.raise_for_status()
+        result = r.json()["chart"]["result"][0]
+        closes = result["indicators"]["quote"][0].get("close", [])
+        bars = [(ts, c) for ts, c in zip(result.get("timestamp", []), closes) if c is not None]
+        # Zonder bar van vandaag (vóór de opening, beursvakantie) is bars[-2] de slotkoers
+        # van twee handelsdagen terug: dan is er nog geen bruikbare vorige slotkoers
+        if len(bars) < 2 or datetime.fromtimestamp(bars[-1][0], AMS_TZ).date() != now.date():
+            return None
+        return float(bars[-2][1])
     except Exception as e:
         print(f"Waarschuwing: vorige slotkoers ophalen mislukt voor {ticker}: {e}", file=sys.stderr)
         return None
 
+def get_closes_batch(tickers: list) -> dict:
+    """Haalt in één yf.download-call de laatste twee slotkoersen op: {symbol: (prev_close, last)}.
+
+    prev_close is None als de laatste bar niet van vandaag is (vóór de eerste trade of op een
+    beursvakantie): dan zou bar -2 de slotkoers van twee handelsdagen terug zijn.
+    """
+    if not tickers:
+        return {}
+    import yfinance as yf
+    try:
+        data = yf.download(
+            tickers=" ".join(tickers), period="5d", interval="1d", group_by="ticker",
+            threads=True, progress=False, auto_adjust=False,
+        )
+    except Exception as e:
+        print(f"Waarschuwing: batch-download mislukt: {e}", file=sys.stderr)
+        return {}
+
+    today = ams_now().date()
+    out = {}
+    for symbol in tickers:
+        try:
+            frame = data[symbol] if data.columns.nlevels > 1 else data
+            closes = frame["Close"].dropna()
+        except KeyError:
+            continue
+        if closes.shape[0] < 2:
+            continue
+        prev = float(closes.iloc[-2]) if closes.index[-1].date() == today else None
+        out[symbol] = (prev, float(closes.iloc[-1]))
+    return out
+
 def ams_now():
-    return datetime.now(tz=tz.gettz("Europe/Amsterdam"))
+    return datetime.now(tz=AMS_TZ)
+
+def market_open(now: datetime) -> bool:
+    return now.weekday() < 5 and MARKET_OPEN <= (now.hour, now.minute) <= MARKET_CLOSE
 
 def within_cooldown(last_time_iso: str, cooldown_minutes: int) -> bool:
     try:
@@ -88,77 +208,149 @@ def within_cooldown(last_time_iso: str, cooldown_minutes: int) -> bool:
 def s_key(*parts) -> str:
     return "::".join(parts)
 
+def in_cooldown(state: dict, key: str, cooldown_minutes: int) -> bool:
+    last_alert = state.get(key, {}).get("last_alert_iso")
+    return bool(last_alert) and within_cooldown(last_alert, cooldown_minutes)
+
+def prune_state(state: dict, max_age_minutes: int) -> int:
+    """Verwijdert alert-entries waarvan de cooldown verlopen is, zodat state.json niet blijft groeien."""
+    stale = [
+        k for k, v in state.items()
+        if isinstance(v, dict) and not within_cooldown(v.get("last_alert_iso", ""), max_age_minutes)
+    ]
+    for k in stale:
+        del state[k]
+    return len(stale)
+
 # ---------- Telegram commands ----------
-def get_updates(offset: int | None):
+def get_updates(offset: int | None, timeout: int = 0):
     url = f"https://api.telegram.org/bot{TELEGRAM_TOKEN}/getUpdates"
-    params = {"timeout": 0}
+    params = {"timeout": timeout}
     if offset is not None:
         params["offset"] = offset
-    r = requests.get(url, params=params, timeout=20)
+    # Client-timeout moet ruim boven de long-poll timeout van Telegram liggen
+    r = _tg.get(url, params=params, timeout=max(20, timeout + 5))
     r.raise_for_status()
     return r.json().get("result", [])
 
+def drain_pending_commands(last_update_id: int | None) -> list:
+    """Leest de door de webhook klaargezette updates, zonder al verwerkte update_ids."""
+    updates = load_json(PENDING_PATH, [])
+    if isinstance(last_update_id, int):
+        updates = [u for u in updates if u.get("update_id", 0) > last_update_id]
+    return sorted(updates, key=lambda u: u.get("update_id", 0))
+
 def normalize_symbol(sym: str) -> str:
     return sym.strip().upper()
 
-def add_or_update_owned(holdings: list, symbol: str, entry: float, shares: float | None, rise_pct: float | None):
-    symbol = normalize_symbol(symbol)
-    found = False
-    for h in holdings:
-        if normalize_symbol(h.get("symbol","")) == symbol:
-            h["status"] = "owned"
-            h["entry_price"] = float(entry)
-            if shares is not None:
-                h["shares"] = shares
-            if rise_pct is not None:
-                h["rise_pct"] = rise_pct
-            found = True
-            break
-    if not found:
-        item = {"symbol": symbol, "status": "owned", "entry_price": float(entry)}
-        if shares is not None:
-            item["shares"] = shares
-        if rise_pct is not None:
-            item["rise_pct"] = rise_pct
-        holdings.append(item)
-
-def add_or_update_watch(holdings: list, symbol: str, baseline: float, drop_pct: float | None):
+def _index(holdings: list) -> dict:
+    """Holdings als {genormaliseerd symbool: record} voor O(1) lookup/update/delete."""
+    return {normalize_symbol(h.get("symbol", "")): h for h in holdings}
+
+def add_or_update_owned(idx: dict, symbol: str, entry: float, shares: float | None, rise_pct: float | None):
     symbol = normalize_symbol(symbol)
-    found = False
-    for h in holdings:
-        if normalize_symbol(h.get("symbol","")) == symbol:
-            h["status"] = "watch"
-            h["baseline"] = float(baseline)
-            if drop_pct is not None:
-                h["drop_pct"] = drop_pct
-            found = True
-            break
-    if not found:
-        item = {"symbol": symbol, "status": "watch", "baseline": float(baseline)}
-        if drop_pct is not None:
-            item["drop_pct"] = drop_pct
-        holdings.append(item)
-
-def remove_symbol(holdings: list, symbol: str) -> bool:
+    h = idx.setdefault(symbol, {"symbol": symbol})
+    h["status"] = "owned"
+    h["entry_price"] = float(entry)
+    if shares is not None:
+        h["shares"] = shares
+    if rise_pct is not None:
+        h["rise_pct"] = rise_pct
+
+def add_or_update_watch(idx: dict, symbol: str, baseline: float, drop_pct: float | None):
     symbol = normalize_symbol(symbol)
-    n_before = len(holdings)
-    holdings[:] = [h for h in holdings if normalize_symbol(h.get("symbol","")) != symbol]
-    return len(holdings) < n_before
+    h = idx.setdefault(symbol, {"symbol": symbol})
+    h["status"] = "watch"
+    h["baseline"] = float(baseline)
+    if drop_pct is not None:
+        h["drop_pct"] = drop_pct
+
+def remove_symbol(idx: dict, symbol: str) -> bool:
+    return idx.pop(normalize_symbol(symbol), None) is not None
+
+def _cmd_buy(parts: list, idx: dict) -> tuple[bool, str]:
+    if len(parts) < 3:
+        return False, "Gebruik: /buy SYMBOL PRICE [SHARES]\nBijv: /buy ASML.AS 850 5"
+    symbol = parts[1]
+    entry = float(parts[2].replace(",", "."))
+    shares = float(parts[3]) if len(parts) >= 4 else None
+    add_or_update_owned(idx, symbol, entry, shares, None)
+    return True, f"✅ OWNED: {html.escape(symbol)} @ {entry}" + (f" ({shares} stuks)" if shares else "")
+
+def _cmd_watch(parts: list, idx: dict) -> tuple[bool, str]:
+    if len(parts) < 3:
+        return False, "Gebruik: /watch SYMBOL BASELINE [DROP_PCT]\nBijv: /watch ADYEN.AS 1200 10"
+    symbol = parts[1]
+    baseline = float(parts[2].replace(",", "."))
+    drop = float(parts[3]) if len(parts) >= 4 else None
+    add_or_update_watch(idx, symbol, baseline, drop)
+    dp = drop if drop is not None else DEFAULT_DROP_PCT
+    return True, f"👀 WATCH: {html.escape(symbol)} baseline {baseline} (drop {dp}%)"
+
+def _cmd_remove(parts: list, idx: dict) -> tuple[bool, str]:
+    if len(parts) < 2:
+        return False, "Gebruik: /sell SYMBOL\nBijv: /sell ASML.AS"
+    symbol = parts[1]
+    if remove_symbol(idx, symbol):
+        return True, f"🗑️ Verwijderd: {html.escape(symbol)}"
+    return False, f"ℹ️ {html.escape(symbol)} stond niet in holdings."
+
+def _cmd_help(parts: list, idx: dict) -> tuple[bool, str]:
+    return False, (
+        "📋 Commando's:\n"
+        "/buy SYMBOL PRICE [SHARES]\n"
+        "/owned SYMBOL PRICE [SHARES]\n"
+        "/watch SYMBOL BASELINE [DROP_PCT]\n"
+        "/sell SYMBOL\n"
+        "/remove SYMBOL\n"
+        "Voorbeeld: /buy ASML.AS 850 5"
+    )
 
-def process_telegram_commands(state: dict) -> bool:
+# Commando -> handler(parts, idx) -> (holdings gewijzigd, antwoord). De handler past alleen
+# holdings aan; het antwoord wordt daarna verstuurd, zodat een mislukte send de wijziging niet kwijtraakt.
+_COMMANDS = {
+    "/buy": _cmd_buy,
+    "/owned": _cmd_buy,
+    "/watch": _cmd_watch,
+    "/sell": _cmd_remove,
+    "/remove": _cmd_remove,
+    "/help": _cmd_help,
+}
+
+def _is_transient(e: requests.RequestException) -> bool:
+    """Netwerkfout, 429 of 5xx: later opnieuw proberen. Andere HTTP-fouten (4xx) zijn permanent."""
+    if isinstance(e, (requests.ConnectionError, requests.Timeout, requests.exceptions.RetryError)):
+        return True
+    status = e.response.status_code if e.response is not None else None
+    return status == 429 or (status is not None and status >= 500)
+
+def process_telegram_commands(state: dict, holdings: list, poll_timeout: int = 0) -> tuple[bool, bool]:
+    """Verwerkt nieuwe commando's en past `holdings` in-place aan.
+
+    Geeft (holdings gewijzigd, alles afgehandeld) terug; het tweede is False als de batch
+    door een tijdelijke Telegram-fout vroegtijdig stopte.
+    """
     changed = False
+    complete = True
     last_update_id = state.get("telegram_last_update_id")
-    updates = get_updates((last_update_id + 1) if isinstance(last_update_id, int) else None)
+    # Met een webhook actief weigert Telegram getUpdates; dan de wachtrij lezen.
+    # De wachtrij wordt hier niet herschreven (dat doet alleen de webhook), de offset filtert.
+    if os.path.exists(PENDING_PATH):
+        updates = drain_pending_commands(last_update_id)
+    else:
+        updates = get_updates((last_update_id + 1) if isinstance(last_update_id, int) else None, poll_timeout)
 
     if not updates:
-        return False
+        return False, True
 
-    holdings = load_json(HOLDINGS_PATH, [])
+    idx = _index(holdings)
+    # Alleen volledig afgehandelde updates tellen mee voor de offset
+    processed_uid = None
     for upd in updates:
         uid = upd.get("update_id")
         msg = upd.get("message") or upd.get("edited_message")
         if not msg:
-            last_update_id = uid
+            processed_uid = uid
             continue
 
         chat = msg.get("chat", {})
@@ -166,80 +358,86 @@ def process_telegram_commands(state: dict) -> bool:
         text = (msg.get("text") or "").strip()
 
         if chat_id != str(TELEGRAM_CHAT_ID):
-            last_update_id = uid
+            processed_uid = uid
             continue
 
         parts = text.split()
         if not parts:
-            last_update_id = uid
+            processed_uid = uid
             continue
 
-        cmd = parts[0].lower()
+        handler = _COMMANDS.get(parts[0].lower())
         try:
-            if cmd in ("/buy", "/owned"):
-                if len(parts) < 3:
-                    send_telegram("Gebruik: /buy SYMBOL PRICE [SHARES]\nBijv: /buy ASML.AS 850 5")
-                else:
-                    symbol = parts[1]
-                    entry = float(parts[2].replace(",", "."))
-                    shares = float(parts[3]) if len(parts) >= 4 else None
-                    add_or_update_owned(holdings, symbol, entry, shares, None)
-                    changed = True
-                    send_telegram(f"✅ OWNED: {symbol} @ {entry}" + (f" ({shares} stuks)" if shares else ""))
-
-            elif cmd == "/watch":
-                if len(parts) < 3:
-                    send_telegram("Gebruik: /watch SYMBOL BASELINE [DROP_PCT]\nBijv: /watch ADYEN.AS 1200 10")
-                else:
-                    symbol = parts[1]
-                    baseline = float(parts[2].replace(",", "."))
-                    drop = float(parts[3]) if len(parts) >= 4 else None
-                    add_or_update_watch(holdings, symbol, baseline, drop)
-                    changed = True
-                    dp = drop if drop is not None else DEFAULT_DROP_PCT
-                    send_telegram(f"👀 WATCH: {symbol} baseline {baseline} (drop {dp}%)")
-
-            elif cmd in ("/sell", "/remove"):
-                if len(parts) < 2:
-                    send_telegram("Gebruik: /sell SYMBOL\nBijv: /sell ASML.AS")
-                else:
-                    symbol = parts[1]
-                    if remove_symbol(holdings, symbol):
-                        changed = True
-                        send_telegram(f"🗑️ Verwijderd: {symbol}")
-                    else:
-                        send_telegram(f"ℹ️ {symbol} stond niet in holdings.")
-
-            elif cmd == "/help":
-                send_telegram(
-                    "📋 Commando's:\n"
-                    "/buy SYMBOL PRICE [SHARES]\n"
-                    "/owned SYMBOL PRICE [SHARES]\n"
-                    "/watch SYMBOL BASELINE [DROP_PCT]\n"
-                    "/sell SYMBOL\n"
-                    "/remove SYMBOL\n"
-                    "Voorbeeld: /buy ASML.AS 850 5"
-                )
-            else:
-                pass
+            if handler:
+                modified, reply = handler(parts, idx)
+                changed |= modified
+                send_telegram(reply)
+        except requests.RequestException as e:
+            if _is_transient(e):
+                # Telegram tijdelijk onbereikbaar: deze en volgende updates de volgende run opnieuw
+                print(f"Update {uid} niet afgerond, volgende run opnieuw: {e}", file=sys.stderr)
+                complete = False
+                break
+            # Permanente fout (bijv. 400): niet eindeloos herhalen, anders blokkeert de rest
+            print(f"Update {uid} overgeslagen: {e}", file=sys.stderr)
         except Exception as e:
-            send_telegram(f"❌ Fout: {e}")
+            try:
+                send_telegram(f"❌ Fout: {html.escape(str(e))}")
+            except requests.RequestException as send_err:
+                if _is_transient(send_err):
+                    complete = False
+                    break
+                print(f"Foutmelding voor update {uid} niet verstuurd: {send_err}", file=sys.stderr)
 
-        last_update_id = uid
+        processed_uid = uid
 
     if changed:
-        save_json(HOLDINGS_PATH, holdings)
-
-    state["telegram_last_update_id"] = last_update_id
-    return changed
+        holdings[:] = idx.values()
+    if processed_uid is not None:
+        state["telegram_last_update_id"] = processed_uid
+    return changed, complete
 
 # ---------- Alerts ----------
-def handle_owned(pos, state):
+# Berichtsjablonen (HTML parse_mode); symbool/naam worden vooraf ge-escaped
+_OWNED_MSG = (
+    "📈 <b>{symbol}</b> staat +{pct:.2f}% t.o.v. jouw entry (€{entry:,.2f}).\n"
+    "Huidige prijs: €{price:,.2f}  |  Doel (≥ {rise_pct:.0f}%): €{target:,.2f}\n"
+    "{shares_line}"
+    "⏰ {ts} (Europe/Amsterdam)\n"
+    "👉 Alert: take-profit drempel bereikt."
+)
+_WATCH_MSG = (
+    "🔻 <b>{symbol}</b> is {pct:.2f}% onder je baseline (€{baseline:,.2f}).\n"
+    "Huidige prijs: €{price:,.2f}  |  Doel (≤ {drop_pct:.0f}%): €{target:,.2f}\n"
+    "⏰ {ts} (Europe/Amsterdam)\n\n"
+    "👉 Alert: koers is ≥{drop_pct:.0f}% gedaald vanaf baseline."
+)
+_UNIVERSE_MSG = (
+    "🔻 <b>{symbol}</b> ({name}) is {pct:.2f}% onder vorige slotkoers (€{baseline:,.2f}).\n"
+    "Huidige prijs: €{price:,.2f}  |  Doel (≤ {drop_pct:.0f}%): €{target:,.2f}\n"
+    "⏰ {ts} (Europe/Amsterdam)\n\n"
+    "👉 Universe-scan: daling ≥{drop_pct:.0f}% t.o.v. vorige close."
+)
+
+def position_alert_key(pos) -> tuple[str, int] | None:
+    """(state-key, cooldown) van het alert voor een holding, of None bij onbekende status."""
+    symbol = pos["symbol"].strip()
+    status = str(pos.get("status","")).strip().lower()
+    if status == "owned":
+        return s_key(symbol, "owned_rise"), COOLDOWN_MINUTES_OWNED
+    if status == "watch":
+        return s_key(symbol, "watch_drop_fixed"), COOLDOWN_MINUTES_WATCH
+    return None
+
+def handle_owned(pos, state, last_price: float | None, outbox: list):
     symbol = pos["symbol"].strip()
+    key = s_key(symbol, "owned_rise")
+    if in_cooldown(state, key, COOLDOWN_MINUTES_OWNED):
+        return False
+
     entry = float(pos["entry_price"])
     rise_pct = float(pos.get("rise_pct", DEFAULT_RISE_PCT))
     shares = pos.get("shares")
-    last_price = get_last_price(symbol)
     if last_price is None:
         return False
     target = entry * (1 + rise_pct / 100.0)
@@ -247,30 +445,23 @@ def handle_owned(pos, state):
     if not hit:
         return False
 
-    key = s_key(symbol, "owned_rise")
-    last_alert = state.get(key, {}).get("last_alert_iso")
-    if last_alert and within_cooldown(last_alert, COOLDOWN_MINUTES_OWNED):
-        return False
-
     pct_move = (last_price / entry - 1.0) * 100.0
     ts = ams_now().strftime("%Y-%m-%d %H:%M")
-    lines = [
-        f"📈 <b>{symbol}</b> staat +{pct_move:.2f}% t.o.v. jouw entry (€{entry:,.2f}).",
-        f"Huidige prijs: €{last_price:,.2f}  |  Doel (≥ {rise_pct:.0f}%): €{target:,.2f}",
-        (f"Aantal: {shares}" if shares is not None else ""),
-        f"⏰ {ts} (Europe/Amsterdam)",
-        "",
-        "👉 Alert: take-profit drempel bereikt."
-    ]
-    send_telegram("\n".join([l for l in lines if l]))
-    state[key] = {"last_alert_iso": ams_now().isoformat()}
+    outbox.append((key, _OWNED_MSG.format_map({
+        "symbol": html.escape(symbol), "pct": pct_move, "entry": entry, "price": last_price,
+        "rise_pct": rise_pct, "target": target, "ts": ts,
+        "shares_line": f"Aantal: {html.escape(str(shares))}\n" if shares is not None else "",
+    })))
     return True
 
-def handle_watch_fixed(pos, state):
+def handle_watch_fixed(pos, state, last_price: float | None, outbox: list):
     symbol = pos["symbol"].strip()
+    key = s_key(symbol, "watch_drop_fixed")
+    if in_cooldown(state, key, COOLDOWN_MINUTES_WATCH):
+        return False
+
     baseline = float(pos["baseline"])
     drop_pct = float(pos.get("drop_pct", DEFAULT_DROP_PCT))
-    last_price = get_last_price(symbol)
     if last_price is None:
         return False
     target = baseline * (1 - drop_pct / 100.0)
@@ -278,24 +469,16 @@ def handle_watch_fixed(pos, state):
     if not hit:
         return False
 
-    key = s_key(symbol, "watch_drop_fixed")
-    last_alert = state.get(key, {}).get("last_alert_iso")
-    if last_alert and within_cooldown(last_alert, COOLDOWN_MINUTES_WATCH):
-        return False
-
     pct_move = (last_price / baseline - 1.0) * 100.0
     ts = ams_now().strftime("%Y-%m-%d %H:%M")
-    msg = (
-        f"🔻 <b>{symbol}</b> is {pct_move:.2f}% onder je baseline (€{baseline:,.2f}).\n"
-        f"Huidige prijs: €{last_price:,.2f}  |  Doel (≤ {drop_pct:.0f}%): €{target:,.2f}\n"
-        f"⏰ {ts} (Europe/Amsterdam)\n\n"
-        f"👉 Alert: koers is ≥{drop_pct:.0f}% gedaald vanaf baseline."
-    )
-    send_telegram(msg)
-    state[key] = {"last_alert_iso": ams_now().isoformat()}
+    outbox.append((key, _WATCH_MSG.format_map({
+        "symbol": html.escape(symbol), "pct": pct_move, "baseline": baseline, "price": last_price,
+        "drop_pct": drop_pct, "target": target, "ts": ts,
+    })))
     return True
 
-def handle_universe(universe_cfg, state):
+def universe_due(universe_cfg, state) -> dict:
+    """{symbol: state-key} van de universe-tickers die niet in cooldown staan."""
     name = universe_cfg.get("name", "UNIVERSE")
     file = universe_cfg["file"]
     drop_pct = float(universe_cfg.get("drop_pct", 10))
@@ -305,45 +488,86 @@ def handle_universe(universe_cfg, state):
     tickers = load_json(file, [])
     if not tickers:
         print(f"Universe '{name}' leeg of niet gevonden: {file}")
-        return False
+        return {}
+
+    if baseline_mode != "prev_close":
+        print(f"Universe '{name}': onbekende baseline_mode '{baseline_mode}'.")
+        return {}
 
-    any_changed = False
+    # Symbolen in cooldown kunnen toch geen alert geven: niet eens ophalen
+    due = {}
     for symbol in tickers:
         symbol = symbol.strip()
-        if baseline_mode == "prev_close":
-            baseline = get_prev_close(symbol)
-            if baseline is None or baseline <= 0:
-                continue
-        else:
-            continue
+        key = s_key("universe", name, symbol, f"drop{int(drop_pct)}")
+        if not in_cooldown(state, key, cooldown_minutes):
+            due[symbol] = key
+    return due
 
-        last_price = get_last_price(symbol)
-        if last_price is None:
-            continue
+def handle_universe(universe_cfg, state, due: dict, quotes: dict, outbox: list):
+    if not due:
+        return False
+    name = universe_cfg.get("name", "UNIVERSE")
+    drop_pct = float(universe_cfg.get("drop_pct", 10))
 
-        target = baseline * (1 - drop_pct / 100.0)
-        hit = last_price <= target
-        if not hit:
-            continue
+    ts = ams_now().strftime("%Y-%m-%d %H:%M")
 
-        key = s_key("universe", name, symbol, f"drop{int(drop_pct)}")
-        last_alert = state.get(key, {}).get("last_alert_iso")
-        if last_alert and within_cooldown(last_alert, cooldown_minutes):
+    rows = []
+    for symbol, key in due.items():
+        quote = quotes.get(normalize_symbol(symbol))
+        if quote:
+            # baseline is None als vandaag nog niet gehandeld is: overslaan, niet terugvallen
+            baseline, last_price = quote
+        else:
+            # Niet in de batch-download: val terug op losse calls
+            baseline = get_prev_close(symbol)
+            last_price = get_last_price(symbol) if baseline else None
+        if baseline is None or baseline <= 0 or last_price is None:
             continue
+        rows.append((symbol, key, baseline, last_price))
+    if not rows:
+        return False
 
-        pct_move = (last_price / baseline - 1.0) * 100.0
-        ts = ams_now().strftime("%Y-%m-%d %H:%M")
-        msg = (
-            f"🔻 <b>{symbol}</b> ({name}) is {pct_move:.2f}% onder vorige slotkoers (€{baseline:,.2f}).\n"
-            f"Huidige prijs: €{last_price:,.2f}  |  Doel (≤ {drop_pct:.0f}%): €{target:,.2f}\n"
-            f"⏰ {ts} (Europe/Amsterdam)\n\n"
-            f"👉 Universe-scan: daling ≥{drop_pct:.0f}% t.o.v. vorige close."
-        )
-        send_telegram(msg)
-        state[key] = {"last_alert_iso": ams_now().isoformat()}
-        any_changed = True
+    # Drempelcheck in één keer over de hele universe
+    import numpy as np
+    baselines = np.array([r[2] for r in rows], dtype=float)
+    lasts = np.array([r[3] for r in rows], dtype=float)
+    targets = baselines * (1.0 - drop_pct / 100.0)
+    pct_moves = (lasts / baselines - 1.0) * 100.0
+
+    alerts = []
+    for i in np.flatnonzero(lasts <= targets):
+        symbol, key, baseline, last_price = rows[i]
+        alerts.append((key, _UNIVERSE_MSG.format_map({
+            "symbol": html.escape(symbol), "name": html.escape(name), "pct": pct_moves[i],
+            "baseline": baseline, "price": last_price, "drop_pct": drop_pct, "target": targets[i], "ts": ts,
+        })))
+
+    if not alerts:
+        return False
 
-    return any_changed
+    # Eén digest per scan i.p.v. een bericht per ticker (Telegram flood limits)
+    outbox.append((None, f"📉 <b>{html.escape(name)}</b> — {len(alerts)} signalen"))
+    outbox.extend(alerts)
+    return True
+
+def flush_alerts(outbox: list, state: dict) -> bool:
+    """Verstuurt alle alerts van deze run gebundeld en zet pas daarna de cooldowns."""
+    if not outbox:
+        return False
+    # Serieel: berichten naar één chat moeten op volgorde aankomen en Telegram begrenst per chat
+    try:
+        for msg in pack_messages([block for _, block in outbox]):
+            send_telegram(msg)
+    except requests.RequestException as e:
+        # Niet laten crashen: anders haalt de workflow de commit-stap (offset/holdings) niet.
+        # Zonder cooldowns worden de alerts volgende run opnieuw geprobeerd.
+        print(f"Alerts versturen mislukt: {e}", file=sys.stderr)
+        return False
+    now_iso = ams_now().isoformat()
+    for key, _ in outbox:
+        if key:
+            state[key] = {"last_alert_iso": now_iso}
+    return True
 
 # ---------- Main ----------
 def main():
@@ -353,31 +577,153 @@ def main():
 
     changed_files = False
     alerts_sent = False
+    outbox = []  # (state-key of None, tekstblok); verstuurd na alle checks
 
     try:
-        if process_telegram_commands(state):
+        changed, _ = process_telegram_commands(state, holdings)
+        if changed:
+            save_json(HOLDINGS_PATH, holdings)
             changed_files = True
     except Exception as e:
         print(f"Fout in commandoprocessing: {e}", file=sys.stderr)
+    # Offset meteen bewaren: een crash tijdens de alerts mag commando's niet opnieuw laten uitvoeren
+    save_json(STATE_PATH, state)
+
+    if not market_open(ams_now()):
+        print("Markt gesloten, alleen commando's verwerkt.")
+        return 0
+
+    # Eén unieke set symbolen over holdings en universes (alleen wat niet in cooldown staat),
+    # opgehaald met één batch-download; Telegram-berichten blijven serieel
+    due_holdings = []
+    for pos in holdings:
+        if not pos.get("symbol"):
+            continue
+        alert = position_alert_key(pos)
+        if alert and not in_cooldown(state, *alert):
+            due_holdings.append(normalize_symbol(pos["symbol"]))
+    universes = config.get("universes", [])
+    due_universes = [universe_due(uni, state) for uni in universes]
+    all_symbols = set(due_holdings).union(*({normalize_symbol(t) for t in due} for due in due_universes))
+
+    quotes = get_closes_batch(sorted(all_symbols))
+    prices = {symbol: last for symbol, (_, last) in quotes.items()}
+    # Wat de batch miste: losse prijzen parallel ophalen
+    prices.update(get_last_prices([symbol for symbol in due_holdings if symbol not in quotes]))
 
     for pos in holdings:
         status = str(pos.get("status","")).strip().lower()
         if status == "owned":
-            alerts_sent |= handle_owned(pos, state)
+            alerts_sent |= handle_owned(pos, state, prices.get(normalize_symbol(pos["symbol"])), outbox)
         elif status == "watch":
             if "baseline" in pos:
-                alerts_sent |= handle_watch_fixed(pos, state)
+                alerts_sent |= handle_watch_fixed(pos, state, prices.get(normalize_symbol(pos["symbol"])), outbox)
             else:
                 print(f"Watch zonder 'baseline' overgeslagen voor {pos.get('symbol')}.")
         else:
             print(f"Overgeslagen {pos.get('symbol')}: onbekende status '{status}'.")
 
-    for uni in config.get("universes", []):
-        alerts_sent |= handle_universe(uni, state)
+    for uni, due in zip(universes, due_universes):
+        alerts_sent |= handle_universe(uni, state, due, quotes, outbox)
+
+    if alerts_sent:
+        flush_alerts(outbox, state)
+
+    # Een entry ouder dan de langste cooldown kan geen alert meer tegenhouden
+    max_cooldown = max(
+        [COOLDOWN_MINUTES_WATCH, COOLDOWN_MINUTES_OWNED]
+        + [int(uni.get("cooldown_minutes", 720)) for uni in universes]
+    )
+    prune_state(state, max_cooldown)
 
     save_json(STATE_PATH, state)
     print("Klaar.")
     return 0
 
+def poll_loop():
+    """Verwerkt Telegram-commando's doorlopend via long polling (buiten de cron om)."""
+    if os.path.exists(PENDING_PATH):
+        print(f"ERROR: --poll werkt niet in webhook-modus ({PENDING_PATH} bestaat).", file=sys.stderr)
+        return 1
+    state = load_json(STATE_PATH, {})
+    holdings = load_json(HOLDINGS_PATH, [])
+    print("Long polling gestart, stoppen met Ctrl+C.")
+    backoff = POLL_BACKOFF_SECONDS
+    try:
+        while True:
+            complete = False
+            try:
+                changed, complete = process_telegram_commands(
+                    state, holdings, poll_timeout=TELEGRAM_LONG_POLL_SECONDS)
+                if changed:
+                    save_json(HOLDINGS_PATH, holdings)
+            except requests.RequestException as e:
+                print(f"Fout bij getUpdates: {e}", file=sys.stderr)
+            # Offset direct bewaren zodat een herstart niet opnieuw verwerkt
+            save_json(STATE_PATH, state)
+            if complete:
+                backoff = POLL_BACKOFF_SECONDS
+            else:
+                # Anders levert getUpdates dezelfde update meteen weer op: tight loop tijdens een storing
+                time.sleep(backoff)
+                backoff = min(backoff * 2, POLL_BACKOFF_MAX_SECONDS)
+    except KeyboardInterrupt:
+        print("Gestopt.")
+    return 0
+
+# ---------- Lokaal draaien / profilen ----------
+def enable_dry_run(fixture_path: str):
+    """Vervangt alle netwerk- en schrijf-I/O door print/fixture, zodat de hot path lokaal te meten is."""
+    fixture = {normalize_symbol(k): v for k, v in load_json(fixture_path, {}).items()}
+    g = globals()
+    g["send_telegram"] = lambda msg: print("[TG]", msg, end="\n\n")
+    g["get_updates"] = lambda offset, timeout=0: []
+    g["get_last_price"] = lambda ticker: fixture.get(normalize_symbol(ticker), {}).get("last")
+    g["get_prev_close"] = lambda ticker: fixture.get(normalize_symbol(ticker), {}).get("prev_close")
+    g["get_closes_batch"] = lambda tickers: {
+        t: (fixture[t]["prev_close"], fixture[t]["last"]) for t in tickers if t in fixture
+    }
+    g["save_json"] = lambda path, data: None
+    # Altijd de volledige scan doorlopen, ook buiten handelstijden
+    g["market_open"] = lambda now: True
+
+def run_profiled(func, out_path: str):
+    import cProfile
+    import pstats
+    profiler = cProfile.Profile()
+    result = profiler.runcall(func)
+    profiler.dump_stats(out_path)
+    pstats.Stats(profiler).sort_stats("cumulative").print_stats(20)
+    print(f"Profiel opgeslagen in {out_path} (bijv. bekijken met snakeviz).")
+    return result
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Stock alerts + Telegram-commando's")
+    parser.add_argument("--poll", action="store_true",
+                        help="alleen Telegram-commando's verwerken via long polling (blijft draaien)")
+    parser.add_argument("--dry-run", action="store_true",
+                        help="geen Yahoo/Telegram-calls en geen schrijfacties; koersen uit --fixture")
+    parser.add_argument("--fixture", default=os.path.join("fixtures", "prices.json"),
+                        help="JSON met {symbol: {prev_close, last}} voor --dry-run")
+    parser.add_argument("--config", help=f"config-bestand (standaard {CONFIG_PATH}, bij --dry-run fixtures/config.json)")
+    parser.add_argument("--holdings", help=f"holdings-bestand (standaard {HOLDINGS_PATH}, bij --dry-run fixtures/holdings.json)")
+    parser.add_argument("--profile", nargs="?", const="stats.prof", metavar="PATH",
+                        help="draai onder cProfile en schrijf de stats naar PATH (standaard stats.prof)")
+    args = parser.parse_args(argv)
+    if args.poll and args.dry_run:
+        parser.error("--poll en --dry-run gaan niet samen")
+    return args
+
 if __name__ == "__main__":
-    sys.exit(main())
+    args = parse_args()
+    if args.dry_run:
+        CONFIG_PATH = os.path.join("fixtures", "config.json")
+        HOLDINGS_PATH = os.path.join("fixtures", "holdings.json")
+        enable_dry_run(args.fixture)
+    elif not TELEGRAM_TOKEN or not TELEGRAM_CHAT_ID:
+        print("ERROR: TELEGRAM_TOKEN en/of TELEGRAM_CHAT_ID ontbreken als secrets.", file=sys.stderr)
+        sys.exit(1)
+    CONFIG_PATH = args.config or CONFIG_PATH
+    HOLDINGS_PATH = args.holdings or HOLDINGS_PATH
+    run = poll_loop if args.poll else main
+    sys.exit(run_profiled(run, args.profile) if args.profile else run())